@@ -1,6 +1,6 @@
 import os
 import sys
-from src.chatbot.core import Chatbot
+from src.chatbot.core import get_chatbot
 
 def main():
     """
@@ -11,8 +11,8 @@ def main():
     print(f"Starting NileCare Chatbot with model: {model_name}")
 
     try:
-        # Initialize our Chatbot instance
-        chatbot = Chatbot(model_name=model_name)
+        # Get the (shared) Chatbot instance
+        chatbot = get_chatbot(model_name=model_name)
 
         print("\n--- Welcome to NileCare Chatbot ---")
         print("Type 'exit' to quit the conversation.")
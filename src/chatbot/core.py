@@ -1,21 +1,77 @@
 # src/chatbot/core.py
 
 import os
+import sys
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 # Ensure the .llm_interface import is correct for relative paths
-from .llm_interface import OllamaClient
-# Import the Retriever from the rag sub-package
-from .rag.retriever import Retriever 
+from .llm_interface import OllamaClient, LLMGenerationError, FALLBACK_RESPONSE
+# Import the Retriever from the rag package
+from ..rag.retriever import Retriever
+
+# Semantic response cache settings: how many previous answers we remember, and how
+# similar (cosine similarity) a new question must be to reuse one of them.
+SEMANTIC_CACHE_CAPACITY = 128
+SEMANTIC_CACHE_THRESHOLD = 0.97
+# Number of recent conversation turns (user + assistant message pairs) sent to the LLM verbatim.
+# Once twice as many have piled up, the older ones are folded into a short summary.
+HISTORY_TURNS_KEPT = 6
+
+# Static instructions, sent as the first (system) message of every request. They never change
+# between turns, so keeping this prefix identical lets Ollama reuse its cached prefill for it.
+RAG_PREAMBLE = (
+    "You are a helpful and informative healthcare chatbot. "
+    "Using *only* the information from the knowledge base provided with the user's question, answer the question concisely and accurately. "
+    "If the question cannot be answered from the provided information, or if it requires personalized medical advice or diagnosis, "
+    "state clearly that you don't have enough information to answer that question and strongly suggest consulting a qualified healthcare professional."
+)
+GEN_PREAMBLE = (
+    "You are a helpful and informative chatbot. Please answer the user's question to the best of your ability. "
+    "If the question is about a specific health condition or requires a diagnosis, you must add a disclaimer "
+    "stating that the information is from your general knowledge and that the user should consult a qualified "
+    "healthcare professional for an accurate diagnosis."
+)
+
+# The LLM model used when none is specified.
+DEFAULT_MODEL_NAME = "Qwen/Qwen1.5-1.8B-Chat"
+
+# Guards the first construction of the shared Chatbot against concurrent requests
+_chatbot_lock = threading.Lock()
+
+def get_chatbot(model_name: str = DEFAULT_MODEL_NAME) -> "Chatbot":
+    """
+    Returns the process-wide Chatbot, creating it on first use.
+    Sharing one instance means the embedding model, ChromaDB client and Ollama client
+    are loaded once per process, no matter how many requests are being served.
+    """
+    with _chatbot_lock:
+        return _get_chatbot(model_name)
+
+@functools.lru_cache(maxsize=1)
+def _get_chatbot(model_name: str) -> "Chatbot":
+    # Always called positionally by get_chatbot, so every call style maps to the same cache key
+    return Chatbot(model_name=model_name)
 
 class Chatbot:
-    def __init__(self, model_name: str = "Qwen/Qwen1.5-1.8B-Chat"):
+    def __init__(self, model_name: str = DEFAULT_MODEL_NAME, use_semantic_cache: bool = True):
         """
         Initializes the main chatbot logic.
         Args:
             model_name (str): The name of the LLM model to use.
+            use_semantic_cache (bool): Whether to answer near-identical questions from
+                                       the semantic response cache instead of the LLM.
         """
         print(f"Initializing Chatbot with LLM model: {model_name}")
         self.llm_client = OllamaClient(model_name=model_name)
         self.chat_history = [] 
+        # The async path runs embedding/retrieval on this single worker thread, so concurrent
+        # requests never use the embedding model at the same time (it already uses all cores).
+        self._model_executor = ThreadPoolExecutor(max_workers=1)
+        # Older turns are summarized every this many turns to keep the prompt size bounded
+        self._summary_every = HISTORY_TURNS_KEPT
 
         # --- NEW RAG SYSTEM INITIALIZATION ---
         self.rag_system = Retriever(
@@ -28,6 +84,19 @@ class Chatbot:
         print("Knowledge base loaded into RAG system.")
         # --- END NEW RAG SYSTEM INITIALIZATION ---
 
+        # --- SEMANTIC RESPONSE CACHE ---
+        # Questions that are (near) paraphrases of earlier ones are answered from memory,
+        # skipping both the ChromaDB retrieval and the LLM call.
+        # Messages are embedded by the RAG system's vector DB, so the cache and the
+        # retrieval always use the same model and normalization.
+        self.use_semantic_cache = use_semantic_cache
+        embedding_dim = self.rag_system.vector_db.embedding_model.get_sentence_embedding_dimension()
+        self._cache_embs = np.empty((SEMANTIC_CACHE_CAPACITY, embedding_dim), dtype=np.float32)
+        self._cache_last_used = np.zeros(SEMANTIC_CACHE_CAPACITY, dtype=np.int64)
+        self._cache_resp = []
+        self._cache_clock = 0
+        # --- END SEMANTIC RESPONSE CACHE ---
+
         print("Chatbot initialized with RAG system and knowledge base loaded.")
 
     def process_message(self, user_message: str) -> str:
@@ -40,57 +109,206 @@ class Chatbot:
         """
         print(f"You: {user_message}")
 
+        # The message is embedded once, for both the semantic cache and the retrieval
+        query_embedding = self.rag_system.vector_db.embed_query(user_message)
+
+        # --- Semantic cache lookup ---
+        # Cached answers were generated without any conversation context, so the cache is only
+        # used for the first message: follow-ups ("Tell me more.") depend on earlier turns.
+        use_cache = self.use_semantic_cache and not self.chat_history
+        if use_cache:
+            cached_response = self._cache_lookup(query_embedding)
+            if cached_response is not None:
+                print("\n--- Answer served from semantic cache ---")
+                self.chat_history.append({'role': 'user', 'content': user_message})
+                self.chat_history.append({'role': 'assistant', 'content': cached_response})
+                # No summarization here: a cache hit must not wait on an LLM call.
+                # The history is trimmed on the next turn that goes to the LLM anyway.
+                print(f"Chatbot: {cached_response}")
+                return cached_response
+
         # --- RAG Step 1: Retrieve relevant information ---
         # We retrieve with a lower similarity threshold to be flexible
-        retrieved_docs = self.rag_system.retrieve_info(user_message, n_results=3, min_similarity=0.4)
-        
-        # This will hold the final prompt we send to the LLM
-        full_prompt = ""
+        retrieved_docs = self.rag_system.retrieve_info(
+            user_message, n_results=3, min_similarity=0.4, query_embedding=query_embedding
+        )
         
         # Check if any documents were actually retrieved
         if retrieved_docs:
             print("\n--- RAG Context Provided to LLM ---")
-            context_str = "\n\nRelevant Information from Knowledge Base:\n"
-            for i, doc in enumerate(retrieved_docs):
-                context_str += f"--- Document {i+1} ---\n"
-                context_str += doc['content'] + "\n"
-            context_str += "\n"
+            context_str = self._format_context(retrieved_docs)
             print(context_str)
             print("-----------------------------------")
-            
-            # This is the RAG-augmented prompt
-            full_prompt = (
-                f"You are a helpful and informative healthcare chatbot. "
-                f"Using *only* the following information from the knowledge base, answer the user's question concisely and accurately. "
-                f"If the question cannot be answered from the provided information, or if it requires personalized medical advice or diagnosis, "
-                f"state clearly that you don't have enough information to answer that question and strongly suggest consulting a qualified healthcare professional.\n\n"
-                f"{context_str}"
-                f"User's Question: {user_message}"
-            )
         else:
             print("\n--- No relevant context found. Falling back to general knowledge. It might not be vey accurate ---")
-            # This is the general-knowledge prompt with the transparency clause
-            full_prompt = (
-                f"You are a helpful and informative chatbot. Please answer the user's question to the best of your ability. "
-                f"If the question is about a specific health condition or requires a diagnosis, you must add a disclaimer "
-                f"stating that the information is from your general knowledge and that the user should consult a qualified "
-                f"healthcare professional for an accurate diagnosis.\n\n"
-                f"User's Question: {user_message}"
-            )
+            context_str = ""
+        system_prompt, full_prompt = self._build_prompt(user_message, context_str)
 
-        # Send the constructed prompt to the LLM
-        response = self.llm_client.generate_response(full_prompt, self.chat_history)
+        # Send the constructed prompt to the LLM and print the answer while it is being generated
+        print("Chatbot: ", end="", flush=True)
+        chunks = []
+        try:
+            for chunk in self.llm_client.stream_response(full_prompt, self.chat_history, system_prompt=system_prompt):
+                sys.stdout.write(chunk)
+                sys.stdout.flush()
+                chunks.append(chunk)
+        except LLMGenerationError:
+            # A partial or failed answer is neither kept in the history nor cached
+            if chunks:
+                print()
+            print(FALLBACK_RESPONSE)
+            return FALLBACK_RESPONSE
+        print()
+        response = "".join(chunks)
 
         # Update chat history
         self.chat_history.append({'role': 'user', 'content': user_message})
         self.chat_history.append({'role': 'assistant', 'content': response})
+        self._trim_history()
+
+        # Remember this answer for future paraphrases of the same question
+        if use_cache:
+            self._cache_store(query_embedding, response)
+
+        return response
+
+    async def process_message_async(self, user_message: str, chat_history: list = None) -> str:
+        """
+        Asynchronous version of process_message for serving many users from one shared Chatbot.
+        The caller owns the conversation, so self.chat_history is neither read nor updated,
+        and nothing is printed. Only the last _summary_every turns of chat_history are used.
+        The semantic cache is shared by all users, so it is only used for the first message
+        of a conversation: later answers may depend on (private) earlier messages.
+        Args:
+            user_message (str): The user's message.
+            chat_history (list): The previous messages of this user's conversation.
+        Returns:
+            str: The chatbot's response.
+        """
+        loop = asyncio.get_running_loop()
+        # Keep the prompt size bounded, like _trim_history does for the REPL conversation
+        chat_history = list(chat_history or [])[-2 * self._summary_every:]
+        use_cache = self.use_semantic_cache and not chat_history
+
+        # The message is embedded once, for both the semantic cache and the retrieval
+        query_embedding = await loop.run_in_executor(self._model_executor, self.rag_system.vector_db.embed_query, user_message)
+
+        # --- Semantic cache lookup ---
+        if use_cache:
+            cached_response = self._cache_lookup(query_embedding)
+            if cached_response is not None:
+                return cached_response
 
-        print(f"Chatbot: {response}")
+        # --- RAG: retrieve relevant information and build the prompt ---
+        retrieved_docs = await loop.run_in_executor(
+            self._model_executor,
+            functools.partial(
+                self.rag_system.retrieve_info,
+                user_message, n_results=3, min_similarity=0.4, query_embedding=query_embedding
+            )
+        )
+        context_str = self._format_context(retrieved_docs) if retrieved_docs else ""
+        system_prompt, full_prompt = self._build_prompt(user_message, context_str)
+
+        try:
+            response = await self.llm_client.generate_response_async(full_prompt, chat_history, system_prompt=system_prompt)
+        except LLMGenerationError:
+            # Failed answers are never cached
+            return FALLBACK_RESPONSE
+
+        if use_cache:
+            self._cache_store(query_embedding, response)
         return response
 
+    def _format_context(self, retrieved_docs: list) -> str:
+        """Formats the retrieved documents into the context block added to the prompt."""
+        # Build the context in one join instead of growing a string document by document
+        context_parts = ["\n\nRelevant Information from Knowledge Base:\n"]
+        for i, doc in enumerate(retrieved_docs, start=1):
+            context_parts.append(f"--- Document {i} ---\n")
+            context_parts.append(doc['content'])
+            context_parts.append("\n")
+        context_parts.append("\n")
+        return "".join(context_parts)
+
+    def _build_prompt(self, user_message: str, context_str: str):
+        """
+        Returns the (system prompt, user prompt) pair sent to the LLM.
+        With retrieved context this is the RAG-augmented prompt; without it, the
+        general-knowledge prompt with the transparency clause.
+        """
+        if context_str:
+            return RAG_PREAMBLE, context_str + "User's Question: " + user_message
+        return GEN_PREAMBLE, "User's Question: " + user_message
+
+    def _trim_history(self):
+        """
+        Keeps the chat history sent to the LLM bounded. When the conversation grows past
+        2 * _summary_every turns, everything but the last _summary_every turns is replaced
+        by a single system message summarizing it.
+        """
+        # The first entry may already be the summary of even older turns
+        summary = []
+        turns = self.chat_history
+        if turns and turns[0]['role'] == 'system':
+            summary, turns = turns[:1], turns[1:]
+
+        keep = 2 * self._summary_every
+        if len(turns) < 2 * keep:
+            return
+
+        older_turns = summary + turns[:-keep]
+        rendered = "\n".join(f"{message['role']}: {message['content']}" for message in older_turns)
+        try:
+            summary_text = self.llm_client.generate_response(
+                "Summarize the following conversation between a user and a healthcare chatbot "
+                "in a few sentences, keeping any facts the user shared about themselves:\n" + rendered,
+                []
+            )
+        except LLMGenerationError:
+            # Keep the full history rather than losing the older turns; we'll retry next turn
+            return
+        self.chat_history = [{'role': 'system', 'content': 'Summary so far: ' + summary_text}] + turns[-keep:]
+
+    def _cache_lookup(self, query_embedding: np.ndarray):
+        """
+        Returns the cached response whose question is most similar to the query,
+        or None if nothing in the cache is similar enough.
+        """
+        n = len(self._cache_resp)
+        if n == 0:
+            return None
+
+        # A single matrix-vector product scores the query against every cached question
+        sims = self._cache_embs[:n] @ query_embedding
+        best = int(np.argmax(sims))
+        if sims[best] < SEMANTIC_CACHE_THRESHOLD:
+            return None
+
+        self._cache_clock += 1
+        self._cache_last_used[best] = self._cache_clock
+        return self._cache_resp[best]
+
+    def _cache_store(self, query_embedding: np.ndarray, response: str):
+        """Adds a (question embedding, response) pair, evicting the least recently used entry when full."""
+        n = len(self._cache_resp)
+        if n < SEMANTIC_CACHE_CAPACITY:
+            slot = n
+            self._cache_resp.append(response)
+        else:
+            slot = int(np.argmin(self._cache_last_used))
+            self._cache_resp[slot] = response
+
+        self._cache_clock += 1
+        self._cache_embs[slot] = query_embedding
+        self._cache_last_used[slot] = self._cache_clock
+
     def reset_conversation(self):
         """Resets the chat history, effectively starting a new conversation."""
         self.chat_history = []
+        # Cached answers may depend on the previous conversation, so forget them as well
+        self._cache_resp = []
+        self._cache_last_used[:] = 0
         print("Chat history reset. Starting a fresh conversation!")
 
 if __name__ == "__main__":
@@ -1,6 +1,26 @@
 import os
+import asyncio
+import threading
+import ollama
 import torch
-from transformers import AutoModelForCausalLM, AutoTokenizer, pipeline
+from transformers import AutoModelForCausalLM, AutoTokenizer, BitsAndBytesConfig, DynamicCache
+
+# Context window requested from Ollama. Changing it between calls reloads the model,
+# which also throws away the cached prompt prefix.
+OLLAMA_NUM_CTX = 4096
+# How long Ollama keeps the model (and its prompt cache) in memory after a request.
+OLLAMA_KEEP_ALIVE = "30m"
+# Generation settings shared by every Ollama request.
+OLLAMA_OPTIONS = {'num_ctx': OLLAMA_NUM_CTX, 'num_predict': 256, 'temperature': 0.6}
+# Async requests arriving within this window (seconds) are dispatched together.
+OLLAMA_BATCH_WINDOW = 0.008
+# Maximum number of async requests dispatched in one batch.
+OLLAMA_MAX_BATCH_SIZE = 8
+# Reply used whenever generation fails.
+FALLBACK_RESPONSE = "Sorry, I am unable to generate a response at this time."
+
+class LLMGenerationError(RuntimeError):
+    """Raised when the LLM fails to produce a response, so callers can decide what to record."""
 
 class LLMInterface:
     def __init__(self, model_name: str):
@@ -12,25 +32,42 @@ class LLMInterface:
         self.model_name = model_name
         self.tokenizer = None
         self.model = None
-        self.pipeline = None
+        # KV cache of the previous call and the token IDs it covers. A new conversation turn
+        # starts with the same tokens, so only the tokens after that prefix need prefilling.
+        self._past_kv = None
+        self._cached_ids = None
 
         print(f"Loading Hugging Face model: {self.model_name}")
         try:
             # Load the tokenizer and model from Hugging Face Hub.
-            # 'torch_dtype="auto"' selects the best dtype available (e.g., float16 on GPU).
             # 'device_map="auto"' distributes the model across available devices (GPU/CPU).
             self.tokenizer = AutoTokenizer.from_pretrained(self.model_name)
-            self.model = AutoModelForCausalLM.from_pretrained(
-                self.model_name,
-                torch_dtype="auto",
-                device_map="auto"
-            )
-            self.pipeline = pipeline(
-                "text-generation",
-                model=self.model,
-                tokenizer=self.tokenizer,
-                max_new_tokens=512
-            )
+            if torch.cuda.is_available():
+                # On a GPU we try to load the weights quantized to 4-bit NF4 with bitsandbytes,
+                # which uses about a quarter of the memory of float16 and speeds up decoding.
+                # Older GPUs such as the T4 have no bfloat16 support, so compute in float16 there.
+                compute_dtype = torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+                quantization_config = BitsAndBytesConfig(
+                    load_in_4bit=True,
+                    bnb_4bit_quant_type="nf4",
+                    bnb_4bit_compute_dtype=compute_dtype
+                )
+                try:
+                    self.model = AutoModelForCausalLM.from_pretrained(
+                        self.model_name,
+                        quantization_config=quantization_config,
+                        device_map="auto"
+                    )
+                except Exception as e:
+                    # bitsandbytes is optional; without it we load the unquantized weights.
+                    print(f"4-bit loading failed ({e}), loading without quantization.")
+            if self.model is None:
+                # bitsandbytes 4-bit kernels need CUDA, so on CPU we keep the default dtype.
+                self.model = AutoModelForCausalLM.from_pretrained(
+                    self.model_name,
+                    torch_dtype="auto",
+                    device_map="auto"
+                )
             print("Hugging Face model loaded successfully.")
         except Exception as e:
             # Provide an informative error message for the user.
@@ -46,6 +83,8 @@ class LLMInterface:
                                   Each dict: {'role': 'user'/'assistant', 'content': 'message'}.
         Returns:
             str: The generated response from the LLM.
+        Raises:
+            LLMGenerationError: If generation fails.
         """
         if chat_history is None:
             chat_history = []
@@ -54,27 +93,233 @@ class LLMInterface:
         messages = chat_history + [{'role': 'user', 'content': prompt}]
 
         try:
-            # The transformers pipeline handles the conversation turn.
-            response = self.pipeline(
+            # Apply the model's chat template ourselves so we can reuse the KV cache of the previous turn.
+            input_ids = self.tokenizer.apply_chat_template(
                 messages,
+                add_generation_prompt=True,
+                return_tensors="pt"
+            ).to(self.model.device)
+
+            past_kv = self._reusable_cache(input_ids)
+            outputs = self.model.generate(
+                input_ids=input_ids,
+                attention_mask=torch.ones_like(input_ids),
+                # generate() only prefills the tokens that are not covered by the cache yet
+                past_key_values=past_kv if past_kv is not None else DynamicCache(),
+                use_cache=True,
+                return_dict_in_generate=True,
+                max_new_tokens=512,
                 do_sample=True,
                 temperature=0.7,
                 top_p=0.95,
+                pad_token_id=self.tokenizer.pad_token_id or self.tokenizer.eos_token_id
             )
-            
-            # The response is a list of dictionaries. We extract the generated content.
-            generated_text = response[0]['generated_text']
-            
-            # Find the last message content, which is the model's response.
-            # This is robust because the pipeline returns the full conversation history.
-            if isinstance(generated_text, list) and generated_text:
-                return generated_text[-1].get('content', '')
-            else:
-                return str(generated_text)
+
+            # Keep the cache for the next turn, together with the tokens it was computed for
+            self._past_kv = outputs.past_key_values
+            self._cached_ids = outputs.sequences[:, :self._past_kv.get_seq_length()]
+
+            # Decode only the newly generated tokens, which are the model's response.
+            new_tokens = outputs.sequences[0, input_ids.shape[1]:]
+            return self.tokenizer.decode(new_tokens, skip_special_tokens=True).strip()
                 
+        except Exception as e:
+            # The cache may be left half-updated, so start from scratch next time
+            self._past_kv = None
+            self._cached_ids = None
+            raise LLMGenerationError(f"Failed to generate a response with {self.model_name}: {e}") from e
+
+    def _reusable_cache(self, input_ids: torch.Tensor):
+        """
+        Returns the KV cache from the previous call, trimmed to the longest prefix its tokens
+        share with input_ids, or None if nothing can be reused.
+        """
+        if self._past_kv is None or self._cached_ids is None:
+            return None
+
+        # At least one input token must be left for the model to process
+        n = min(self._cached_ids.shape[1], input_ids.shape[1] - 1)
+        mismatches = torch.nonzero(self._cached_ids[0, :n] != input_ids[0, :n])
+        prefix_len = int(mismatches[0]) if len(mismatches) else n
+        if prefix_len == 0:
+            return None
+
+        self._past_kv.crop(prefix_len)
+        return self._past_kv
+
+class OllamaClient:
+    def __init__(self, model_name: str):
+        """
+        Initializes the LLM interface using a model served by a local Ollama server.
+        Args:
+            model_name (str): The name of the Ollama model to use.
+        """
+        self.model_name = model_name
+
+        # State for the async micro-batcher. It is bound to an event loop,
+        # so it is created lazily by the first async request on each loop.
+        self._async_client = None
+        self._request_queue = None
+        self._batch_loop = None
+        self._batch_worker = None
+        self._pending_batches = set()
+
+        print(f"Connecting to Ollama model: {self.model_name}")
+        try:
+            # Ask for the model's metadata to make sure the server is up and the model exists.
+            # Unlike a chat request, this does not load the model weights.
+            ollama.show(self.model_name)
+            print("Ollama model is ready.")
+        except ollama.ResponseError as e:
+            print(f"Failed to reach Ollama model {self.model_name}: {e.error}")
+            raise RuntimeError(f"Failed to reach Ollama model {self.model_name}: {e.error}")
+
+        # Load the model in the background, so the first real question does not wait for it
+        threading.Thread(target=self._warm_up, daemon=True).start()
+
+    def _warm_up(self):
+        """Sends a one-token request so Ollama loads the model into memory."""
+        try:
+            ollama.chat(
+                model=self.model_name,
+                messages=[{'role': 'user', 'content': 'Hi'}],
+                # Same context size as real requests, otherwise Ollama would reload the model
+                options={'num_ctx': OLLAMA_NUM_CTX, 'num_predict': 1},
+                keep_alive=OLLAMA_KEEP_ALIVE
+            )
+        except Exception as e:
+            print(f"Warning: could not warm up Ollama model {self.model_name}: {e}")
+
+    def _build_messages(self, prompt: str, chat_history: list = None, system_prompt: str = None) -> list:
+        """Builds the message list sent to Ollama for a prompt, its chat history and optional system prompt."""
+        if chat_history is None:
+            chat_history = []
+
+        # Construct the full message list for the LLM: the static system prompt first
+        # (so the shared prefix stays identical across turns), then history and the new prompt.
+        messages = chat_history + [{'role': 'user', 'content': prompt}]
+        if system_prompt:
+            messages = [{'role': 'system', 'content': system_prompt}] + messages
+        return messages
+
+    def stream_response(self, prompt: str, chat_history: list = None, system_prompt: str = None):
+        """
+        Generates a response from the LLM, yielding text chunks as soon as they are produced.
+        Args:
+            prompt (str): The user's current prompt, which can include RAG context.
+            chat_history (list): A list of dictionaries representing previous messages.
+                                  Each dict: {'role': 'user'/'assistant', 'content': 'message'}.
+            system_prompt (str): Optional fixed instructions, sent as the first message.
+        Yields:
+            str: The next piece of the generated response.
+        Raises:
+            LLMGenerationError: If generation fails, possibly after some chunks were already yielded.
+        """
+        messages = self._build_messages(prompt, chat_history, system_prompt)
+
+        try:
+            # With stream=True Ollama returns the answer token by token,
+            # so the user starts seeing text right after the first token is decoded.
+            for part in ollama.chat(
+                model=self.model_name,
+                messages=messages,
+                stream=True,
+                # A fixed context size and keep_alive keep the same runner (and its prompt cache)
+                # loaded between turns, so Ollama can skip prefill for the matching prefix.
+                options=OLLAMA_OPTIONS,
+                keep_alive=OLLAMA_KEEP_ALIVE
+            ):
+                yield part['message']['content']
         except Exception as e:
             print(f"Error generating response: {e}")
-            return "Sorry, I am unable to generate a response at this time."
+            raise LLMGenerationError(f"Failed to generate a response with {self.model_name}: {e}") from e
+
+    def generate_response(self, prompt: str, chat_history: list = None, system_prompt: str = None) -> str:
+        """
+        Generates a complete response from the LLM based on a prompt and chat history.
+        Args:
+            prompt (str): The user's current prompt, which can include RAG context.
+            chat_history (list): A list of dictionaries representing previous messages.
+            system_prompt (str): Optional fixed instructions, sent as the first message.
+        Returns:
+            str: The generated response from the LLM.
+        Raises:
+            LLMGenerationError: If generation fails.
+        """
+        return "".join(self.stream_response(prompt, chat_history, system_prompt=system_prompt))
+
+    async def generate_response_async(self, prompt: str, chat_history: list = None, system_prompt: str = None) -> str:
+        """
+        Asynchronous version of generate_response for serving several users at once.
+        Requests arriving close together are sent to Ollama as one concurrent batch,
+        so the server can process them together instead of one after another.
+        Args:
+            prompt (str): The user's current prompt, which can include RAG context.
+            chat_history (list): A list of dictionaries representing previous messages.
+            system_prompt (str): Optional fixed instructions, sent as the first message.
+        Returns:
+            str: The generated response from the LLM.
+        Raises:
+            LLMGenerationError: If generation fails.
+        """
+        self._ensure_batch_worker()
+        future = self._batch_loop.create_future()
+        await self._request_queue.put((self._build_messages(prompt, chat_history, system_prompt), future))
+        return await future
+
+    def _ensure_batch_worker(self):
+        """Starts the batching worker (and its queue and client) for the currently running event loop."""
+        loop = asyncio.get_running_loop()
+        if self._batch_loop is loop and self._batch_worker is not None and not self._batch_worker.done():
+            return
+
+        self._async_client = ollama.AsyncClient()
+        self._request_queue = asyncio.Queue()
+        self._batch_loop = loop
+        self._batch_worker = loop.create_task(self._run_batch_worker())
+
+    async def _run_batch_worker(self):
+        """Collects queued requests into small batches and dispatches each batch to Ollama."""
+        while True:
+            # Wait for the first request, then gather whatever else arrives within the batch window
+            batch = [await self._request_queue.get()]
+            while len(batch) < OLLAMA_MAX_BATCH_SIZE:
+                try:
+                    batch.append(await asyncio.wait_for(self._request_queue.get(), timeout=OLLAMA_BATCH_WINDOW))
+                except asyncio.TimeoutError:
+                    break
+
+            # Dispatch without waiting, so the next batch can be collected while this one generates
+            task = asyncio.ensure_future(self._dispatch_batch(batch))
+            self._pending_batches.add(task)
+            task.add_done_callback(self._pending_batches.discard)
+
+    async def _dispatch_batch(self, batch: list):
+        """Sends every request of a batch to Ollama concurrently and resolves the waiting futures."""
+        results = await asyncio.gather(
+            *[
+                self._async_client.chat(
+                    model=self.model_name,
+                    messages=messages,
+                    options=OLLAMA_OPTIONS,
+                    keep_alive=OLLAMA_KEEP_ALIVE
+                )
+                for messages, _ in batch
+            ],
+            return_exceptions=True
+        )
+
+        for (_, future), result in zip(batch, results):
+            if future.done():
+                # The caller gave up (e.g. was cancelled) before the answer arrived
+                continue
+            if isinstance(result, Exception):
+                print(f"Error generating response: {result}")
+                future.set_exception(
+                    LLMGenerationError(f"Failed to generate a response with {self.model_name}: {result}")
+                )
+            else:
+                future.set_result(result['message']['content'])
 
 # --- Test the LLMInterface ---
 if __name__ == "__main__":
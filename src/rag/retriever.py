@@ -0,0 +1,44 @@
+# src/rag/retriever.py
+
+from typing import List, Dict, Any
+import numpy as np
+from .vector_db import VectorDB
+
+class Retriever:
+    def __init__(self, db_path: str = "data/chroma_db", collection_name: str = "nilecare_knowledge",
+                 knowledge_file_path: str = "data/knowledge_base.txt"):
+        """
+        Initializes the Retriever, which finds knowledge base documents relevant to a user's message.
+        Args:
+            db_path (str): The ChromaDB directory.
+            collection_name (str): The name of the ChromaDB collection holding the knowledge base.
+            knowledge_file_path (str): The path to the knowledge base text file.
+        """
+        self.vector_db = VectorDB(
+            knowledge_file_path=knowledge_file_path,
+            db_path=db_path,
+            collection_name=collection_name
+        )
+
+    def retrieve_info(self, query: str, n_results: int = 5, min_similarity: float = 0.0,
+                      query_embedding: np.ndarray = None) -> List[Dict[str, Any]]:
+        """
+        Retrieves the documents most relevant to a query.
+        Args:
+            query (str): The user's message.
+            n_results (int): The maximum number of documents to retrieve.
+            min_similarity (float): Documents with a lower cosine similarity to the query are dropped.
+            query_embedding (np.ndarray): Optional normalized embedding of the query, to avoid embedding it again.
+        Returns:
+            List[Dict[str, Any]]: The relevant documents, most similar first, each with its
+                                   content, metadata, distance and similarity.
+        """
+        results = self.vector_db.query(query, query_embedding=query_embedding, n_results=n_results)
+
+        # Our collection uses cosine distance, so similarity is simply 1 - distance
+        relevant_docs = []
+        for result in results:
+            similarity = 1.0 - result['distance']
+            if similarity >= min_similarity:
+                relevant_docs.append({**result, 'similarity': similarity})
+        return relevant_docs
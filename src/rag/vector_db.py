@@ -1,142 +1,495 @@
 # src/chatbot/rag/vector_db.py
 
 import os
+import sys
+import platform
+import mmap
+import hashlib
 from typing import List, Dict, Any
+import numpy as np
+import torch
 import chromadb
-from chromadb.utils import embedding_functions
+import chromadb.errors
+from chromadb.api.types import Documents, EmbeddingFunction, Embeddings
 from sentence_transformers import SentenceTransformer
-import uuid
+
+# Name of the SentenceTransformer model used for all embeddings.
+EMBEDDING_MODEL_NAME = "all-MiniLM-L6-v2"
+# Pre-quantized (dynamic int8) ONNX exports of the model, as published in its Hugging Face repository.
+ONNX_INT8_FILE_ARM64 = "onnx/model_qint8_arm64.onnx"
+ONNX_INT8_FILE_X86 = "onnx/model_quint8_avx2.onnx"
+# Bump this whenever the way the knowledge base is split into documents (or how they are
+# identified) changes, so that existing collections are re-ingested.
+CHUNKER_VERSION = "2"
+# Number of documents embedded per forward pass during ingestion.
+EMBEDDING_BATCH_SIZE = 256
+# Number of texts embedded per forward pass when ChromaDB calls the embedding function.
+QUERY_BATCH_SIZE = 128
+# HNSW index settings for the knowledge base collection. Cosine distance matches our
+# normalized MiniLM embeddings, and a larger M / construction_ef improves recall.
+HNSW_METADATA = {"hnsw:space": "cosine", "hnsw:construction_ef": 200, "hnsw:M": 32}
+# Bump this whenever HNSW_METADATA changes. Index settings cannot be changed on an existing
+# collection, so a collection built with older settings is recreated once.
+INDEX_VERSION = "1"
+# Exceptions ChromaDB raises from get_collection when the collection does not exist.
+# The exception type differs between versions (ValueError, InvalidCollectionException, NotFoundError).
+COLLECTION_NOT_FOUND_ERRORS = (ValueError,) + tuple(
+    getattr(chromadb.errors, name)
+    for name in ("NotFoundError", "InvalidCollectionException")
+    if hasattr(chromadb.errors, name)
+)
+# File name suffixes (inside the ChromaDB directory, prefixed by the collection name)
+# of the fast-path embedding matrix and its document IDs.
+FAST_INDEX_EMBEDDINGS_FILE = "embs.f16"
+FAST_INDEX_IDS_FILE = "ids.npy"
+# Above this many documents, queries go through ChromaDB's HNSW index instead of the fast path.
+FAST_PATH_MAX_DOCS = 10000
+
+# Separator between documents in the knowledge base file.
+DOCUMENT_DELIMITER = b"---"
+
+def _iter_knowledge_documents(knowledge_file_path: str):
+    """
+    Yields (title, content) pairs for the documents of a knowledge base file.
+    Documents are separated by DOCUMENT_DELIMITER and their first line is the title.
+    The file is scanned once through mmap, so only one document at a time is copied
+    out of it instead of the whole file plus a list of every document.
+    """
+    with open(knowledge_file_path, "rb") as f:
+        # An empty file cannot be memory-mapped (and holds no documents anyway)
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            # We read the file front to back exactly once: let the kernel read ahead
+            # aggressively so the disk stays busy while we parse (where supported).
+            if hasattr(mmap, "MADV_SEQUENTIAL"):
+                mm.madvise(mmap.MADV_SEQUENTIAL)
+            start = 0
+            size = len(mm)
+            while start <= size:
+                end = mm.find(DOCUMENT_DELIMITER, start)
+                if end == -1:
+                    end = size
+
+                chunk = mm[start:end].strip()
+                start = end + len(DOCUMENT_DELIMITER)
+                if not chunk:
+                    continue
+
+                # Extract the first line as the title
+                newline = chunk.find(b"\n")
+                if newline == -1:
+                    title, content = chunk, b""
+                else:
+                    title, content = chunk[:newline], chunk[newline + 1:]
+                yield (
+                    title.strip().decode("utf-8"),
+                    content.strip().decode("utf-8").replace("\r\n", "\n")
+                )
+
+class _SharedEmbeddingFunction(EmbeddingFunction):
+    """
+    ChromaDB embedding function that delegates to an already-loaded SentenceTransformer,
+    so ChromaDB does not load a second copy of the model.
+    """
+    def __init__(self, model: SentenceTransformer):
+        self.model = model
+
+    def __call__(self, input: Documents) -> Embeddings:
+        # ChromaDB requires the argument to be named 'input'.
+        # We hand back contiguous float32 arrays (one row view per text) rather than
+        # Python lists of floats, which ChromaDB would only convert back to arrays.
+        # This needs chromadb>=0.6; older versions only accept lists (see requirements.txt).
+        embeddings = self.model.encode(
+            input,
+            batch_size=QUERY_BATCH_SIZE,
+            normalize_embeddings=True,
+            convert_to_numpy=True
+        ).astype(np.float32, copy=False)
+        return list(embeddings)
 
 class VectorDB:
-    def __init__(self, knowledge_file_path: str):
+    def __init__(self, knowledge_file_path: str, db_path: str = None, collection_name: str = "nilecare_knowledge"):
         """
         Initializes the VectorDB with a ChromaDB client and a sentence transformer for embeddings.
         Args:
             knowledge_file_path (str): The path to the knowledge base text file.
+            db_path (str): Optional ChromaDB directory. Derived from knowledge_file_path if not given.
+            collection_name (str): The name of the ChromaDB collection holding the knowledge base.
         """
         self.knowledge_file_path = knowledge_file_path
         
         # Determine the ChromaDB directory from the knowledge file path
         # This makes the path relative to the project structure
-        db_directory = os.path.dirname(os.path.dirname(self.knowledge_file_path))
-        if not db_directory:
-            db_directory = os.path.join(os.getcwd(), 'data', 'chroma_db')
+        if db_path:
+            db_directory = db_path
         else:
-            db_directory = os.path.join(db_directory, 'chroma_db')
+            db_directory = os.path.dirname(os.path.dirname(self.knowledge_file_path))
+            if not db_directory:
+                db_directory = os.path.join(os.getcwd(), 'data', 'chroma_db')
+            else:
+                db_directory = os.path.join(db_directory, 'chroma_db')
 
         # Create the ChromaDB client to connect to the database.
         # This will store the database files in the specified directory.
+        self.db_directory = db_directory
         self.client = chromadb.PersistentClient(path=db_directory)
 
         # Initialize the SentenceTransformer model.
         # This model converts text into numerical vectors (embeddings).
         # We use a specific model that's good for semantic search.
-        self.embedding_model = SentenceTransformer("all-MiniLM-L6-v2")
+        # On a GPU we also switch the weights to half precision to speed up encoding.
+        # On a CPU we use the int8-quantized ONNX Runtime version of the model when available.
+        self.device = "cuda" if torch.cuda.is_available() else "cpu"
+        self.embedding_backend = "torch"
+        if self.device == "cuda":
+            self.embedding_model = self._load_torch_model()
+            self.embedding_model.half()
+        else:
+            self.embedding_model = self._load_onnx_int8_model()
+            if self.embedding_model is not None:
+                self.embedding_backend = "onnx-int8"
+            else:
+                self.embedding_model = self._load_torch_model()
 
         # Create or get a collection in the database. A collection is where documents are stored.
         # We use a simple name for our knowledge base.
-        self.collection_name = "nilecare_knowledge"
-        self.collection = self.client.get_or_create_collection(
-            name=self.collection_name,
-            # We must specify the embedding function to match our SentenceTransformer model.
-            embedding_function=self._get_embedding_function()
-        )
+        self.collection_name = collection_name
+        self.collection = self._get_or_create_collection()
+        if (self.collection.metadata or {}).get("index_version") != INDEX_VERSION:
+            # This collection was built with different index settings: rebuild it from scratch
+            self.client.delete_collection(name=self.collection_name)
+            self.collection = self._get_or_create_collection()
+            print("Existing knowledge base cleared from database (index settings changed).")
+
+        # Fast retrieval path: for a small knowledge base, scoring every document with one
+        # matrix-vector product is quicker than going through ChromaDB. The embeddings are
+        # stored on disk as float16 (half the size) and kept in memory as float32, so queries
+        # use NumPy's BLAS product without converting the matrix each time. The index also
+        # keeps the matching IDs, documents and metadata.
+        self._use_fast_path = True
+        self._fast_embs = None
+        self._fast_ids = []
+        self._fast_documents = []
+        self._fast_metadatas = []
 
         print(f"VectorDB initialized. ChromaDB path: {db_directory}")
 
+    def _load_torch_model(self):
+        """
+        Loads the embedding model on the PyTorch backend using fused scaled-dot-product attention
+        (SDPA), which runs the attention matmuls as a single optimized kernel on both CPU and GPU.
+        """
+        try:
+            return SentenceTransformer(
+                EMBEDDING_MODEL_NAME,
+                device=self.device,
+                model_kwargs={"attn_implementation": "sdpa"}
+            )
+        except ValueError as e:
+            # Older transformers versions do not support SDPA for this architecture
+            print(f"SDPA attention not available ({e}). Using the default attention implementation.")
+            return SentenceTransformer(EMBEDDING_MODEL_NAME, device=self.device)
+
+    def _load_onnx_int8_model(self):
+        """
+        Loads the embedding model on the ONNX Runtime backend with int8 weights.
+        Returns None if the ONNX dependencies (sentence-transformers[onnx]) are not installed.
+        """
+        machine = platform.machine().lower()
+        file_name = ONNX_INT8_FILE_ARM64 if machine in ("arm64", "aarch64") else ONNX_INT8_FILE_X86
+        try:
+            model = SentenceTransformer(
+                EMBEDDING_MODEL_NAME,
+                device=self.device,
+                backend="onnx",
+                model_kwargs={"file_name": file_name}
+            )
+        except Exception as e:
+            print(f"Could not load the int8 ONNX embedding model ({e}). Falling back to PyTorch.")
+            return None
+        print(f"Using int8 ONNX Runtime embedding model: {file_name}")
+        return model
+
+    def _get_or_create_collection(self):
+        """Creates or gets the knowledge base collection with our embedding function and index settings."""
+        # We don't use get_or_create_collection: on some ChromaDB versions it overwrites the
+        # metadata of an existing collection, which would erase the stored kb_hash and index_version.
+        # The index settings are therefore only passed when the collection is actually created.
+        try:
+            return self.client.get_collection(
+                name=self.collection_name,
+                embedding_function=self._get_embedding_function()
+            )
+        except COLLECTION_NOT_FOUND_ERRORS:
+            # The collection does not exist yet. Any other error (e.g. a database problem) propagates.
+            return self.client.create_collection(
+                name=self.collection_name,
+                # We must specify the embedding function to match our SentenceTransformer model.
+                embedding_function=self._get_embedding_function(),
+                metadata={**HNSW_METADATA, "index_version": INDEX_VERSION}
+            )
+
     def _get_embedding_function(self):
         """
         Returns a custom embedding function to wrap the SentenceTransformer model.
         ChromaDB needs a function that takes a list of texts and returns a list of embeddings.
         """
-        def embed_documents(texts: List[str]) -> List[List[float]]:
-            """Converts a list of texts to a list of embeddings."""
-            # The .encode() method from SentenceTransformer does exactly what we need.
-            return self.embedding_model.encode(texts).tolist()
+        return _SharedEmbeddingFunction(self.embedding_model)
 
-        return embedding_functions.SentenceTransformerEmbeddingFunction(
-            model_name="all-MiniLM-L6-v2"
-        )
+    def _knowledge_base_fingerprint(self, knowledge_file_path: str) -> str:
+        """
+        Computes a fingerprint of the knowledge base file contents, the embedding model
+        (and backend) and the chunker version. If none of these change, the stored embeddings are still valid.
+        """
+        digest = hashlib.blake2b()
+        with open(knowledge_file_path, "rb") as f:
+            # mmap lets us hash the file without copying it into a Python string.
+            # An empty file cannot be memory-mapped, so we simply skip it.
+            if os.fstat(f.fileno()).st_size > 0:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    digest.update(mm)
+        # The backend is part of the fingerprint: int8 and fp32 embeddings differ slightly
+        digest.update(f"{EMBEDDING_MODEL_NAME}:{self.embedding_backend}:{CHUNKER_VERSION}".encode("utf-8"))
+        return digest.hexdigest()
 
-    def load_knowledge_base(self):
+    def load_knowledge_base(self, knowledge_file_path: str = None):
         """
         Reads the knowledge base file, chunks the text, and stores it in the vector database.
+        Ingestion is skipped if the collection already holds this exact knowledge base.
+        Args:
+            knowledge_file_path (str): Optional path overriding the one given at initialization.
         """
+        if knowledge_file_path is not None:
+            self.knowledge_file_path = knowledge_file_path
+
         print(f"Loading knowledge base from: {self.knowledge_file_path}")
         try:
-            with open(self.knowledge_file_path, "r", encoding="utf-8") as f:
-                raw_text = f.read()
+            kb_hash = self._knowledge_base_fingerprint(self.knowledge_file_path)
         except FileNotFoundError:
             print(f"Error: Knowledge base file not found at {self.knowledge_file_path}")
             return
 
-        # Split the text into documents based on the "---" delimiter
-        documents = raw_text.strip().split("---")
-        
-        # Clear the collection to avoid duplicate data on re-runs
-        self.client.delete_collection(name=self.collection_name)
-        self.collection = self.client.get_or_create_collection(
-            name=self.collection_name,
-            embedding_function=self._get_embedding_function()
-        )
-        print("Existing knowledge base cleared from database.")
-        
+        # If the stored collection was built from the same file, model and chunker, we're done
+        stored_metadata = self.collection.metadata or {}
+        if stored_metadata.get("kb_hash") == kb_hash:
+            print("Knowledge base unchanged since last load. Skipping ingestion.")
+            self._load_fast_index()
+            return
+
         texts = []
         metadatas = []
         ids = []
+        seen_ids = set()
 
-        for doc_text in documents:
-            if doc_text.strip():
-                # Extract the first line as the title
-                lines = doc_text.strip().split("\n")
-                title = lines[0].strip() if lines else "Untitled"
-                content = "\n".join(lines[1:]).strip()
-                
-                if content:
-                    texts.append(content)
-                    metadatas.append({"title": title})
-                    ids.append(str(uuid.uuid4()))
+        for title, content in _iter_knowledge_documents(self.knowledge_file_path):
+            if content:
+                # Documents are identified by a short (16 hex chars) hash of their title and
+                # content, so an unchanged document keeps the same ID across loads.
+                doc_id = hashlib.blake2b(f"{title}\n{content}".encode("utf-8"), digest_size=8).hexdigest()
+                if doc_id in seen_ids:
+                    continue
+                seen_ids.add(doc_id)
+                texts.append(content)
+                # Many documents share the same title, so we keep a single copy of each
+                metadatas.append({"title": sys.intern(title)})
+                ids.append(doc_id)
+
+        # Document IDs only depend on the text, so vectors made by another model, backend or
+        # chunker would be kept as they are. They must not be mixed with new ones (they may even
+        # have a different dimension), so in that case the collection is rebuilt from scratch.
+        stored_settings = (
+            stored_metadata.get("model"),
+            stored_metadata.get("backend"),
+            stored_metadata.get("chunker_version")
+        )
+        if self.collection.count() > 0 and stored_settings != (EMBEDDING_MODEL_NAME, self.embedding_backend, CHUNKER_VERSION):
+            self.client.delete_collection(name=self.collection_name)
+            self.collection = self._get_or_create_collection()
+            print("Existing knowledge base cleared from database (embedding settings changed).")
+
+        # Remove documents that are no longer in the knowledge base
+        existing_ids = set(self.collection.get(include=[])["ids"])
+        stale_ids = list(existing_ids - seen_ids)
+        if stale_ids:
+            self.collection.delete(ids=stale_ids)
+            print(f"Removed {len(stale_ids)} outdated documents from the vector database.")
+
+        # Only new or edited documents need to be embedded and stored
+        new_docs = [i for i, doc_id in enumerate(ids) if doc_id not in existing_ids]
+        texts = [texts[i] for i in new_docs]
+        metadatas = [metadatas[i] for i in new_docs]
+        ids = [ids[i] for i in new_docs]
         
         # Add the documents and their metadata to the ChromaDB collection
         print(f"Adding {len(texts)} documents to the vector database...")
         if texts:
-            self.collection.add(
+            # Embed all documents ourselves in large batches instead of letting
+            # ChromaDB call the embedding function in small chunks.
+            embeddings = self.embedding_model.encode(
+                texts,
+                batch_size=EMBEDDING_BATCH_SIZE,
+                convert_to_numpy=True,
+                normalize_embeddings=True,
+                show_progress_bar=False
+            ).astype(np.float32, copy=False)
+            self.collection.upsert(
                 documents=texts,
+                embeddings=embeddings,
                 metadatas=metadatas,
                 ids=ids
             )
             print("Knowledge base successfully loaded.")
-        else:
+        elif not seen_ids:
             print("No valid documents found in the knowledge base file.")
+        else:
+            print("All documents are already up to date.")
+
+        self._write_fast_index()
+
+        # Record the fingerprint only once ingestion succeeded, so the next startup can skip it.
+        # ChromaDB does not allow changing the hnsw:* settings here, so they are left out.
+        self.collection.modify(metadata={
+            "kb_hash": kb_hash,
+            "model": EMBEDDING_MODEL_NAME,
+            "backend": self.embedding_backend,
+            "chunker_version": CHUNKER_VERSION,
+            "index_version": INDEX_VERSION
+        })
+
+    def _fast_index_paths(self):
+        """Returns the (embeddings, IDs) file paths of this collection's fast-path index."""
+        prefix = os.path.join(self.db_directory, self.collection_name)
+        return f"{prefix}.{FAST_INDEX_EMBEDDINGS_FILE}", f"{prefix}.{FAST_INDEX_IDS_FILE}"
+
+    def _write_fast_index(self):
+        """Saves all document embeddings as a float16 memmap (plus their IDs) next to the database."""
+        data = self.collection.get(include=["embeddings", "documents", "metadatas"])
+        ids = data["ids"]
+        if not ids or len(ids) > FAST_PATH_MAX_DOCS:
+            # Fast path disabled: also remove any saved index, so that a later startup
+            # cannot load an old index that only covers part of the collection.
+            self._fast_embs = None
+            for path in self._fast_index_paths():
+                if os.path.exists(path):
+                    os.remove(path)
+            return
+
+        embeddings = np.asarray(data["embeddings"], dtype=np.float32)
+        embs_path, ids_path = self._fast_index_paths()
+        embs = np.memmap(embs_path, dtype=np.float16, mode="w+", shape=embeddings.shape)
+        embs[:] = embeddings
+        embs.flush()
+        np.save(ids_path, np.asarray(ids))
+
+        self._fast_embs = embeddings
+        self._fast_ids = ids
+        self._fast_documents = data["documents"]
+        self._fast_metadatas = data["metadatas"]
+
+    def _load_fast_index(self):
+        """Loads the fast-path index saved by _write_fast_index, rebuilding it if it is missing or stale."""
+        embs_path, ids_path = self._fast_index_paths()
+        if not (os.path.exists(embs_path) and os.path.exists(ids_path)):
+            self._write_fast_index()
+            return
+
+        try:
+            ids = np.load(ids_path).tolist()
+            embs = np.memmap(embs_path, dtype=np.float16, mode="r")
+        except (OSError, ValueError):
+            # Unreadable or empty index files
+            self._write_fast_index()
+            return
+
+        embedding_dim = self.embedding_model.get_sentence_embedding_dimension()
+        if (not ids or len(ids) > FAST_PATH_MAX_DOCS
+                or len(ids) != self.collection.count()
+                or embs.size != len(ids) * embedding_dim):
+            # The saved index no longer matches the collection (or the file is truncated)
+            self._write_fast_index()
+            return
+
+        data = self.collection.get(ids=ids, include=["documents", "metadatas"])
+        if len(data["ids"]) != len(ids):
+            # Some saved IDs are no longer in the collection
+            self._write_fast_index()
+            return
+
+        # ChromaDB does not guarantee the order of get() results, so realign them with our IDs
+        by_id = {doc_id: (doc, meta) for doc_id, doc, meta in zip(data["ids"], data["documents"], data["metadatas"])}
+        # Convert to float32 once here, rather than on every query
+        self._fast_embs = embs.reshape(len(ids), embedding_dim).astype(np.float32)
+        self._fast_ids = ids
+        self._fast_documents = [by_id[doc_id][0] for doc_id in ids]
+        self._fast_metadatas = [by_id[doc_id][1] for doc_id in ids]
 
-    def query(self, text: str, n_results: int = 5) -> List[Dict[str, Any]]:
+    def embed_query(self, text: str) -> np.ndarray:
+        """Embeds a query text into a normalized float32 vector (so dot product == cosine similarity)."""
+        return self.embedding_model.encode(
+            text,
+            normalize_embeddings=True,
+            convert_to_numpy=True
+        ).astype(np.float32, copy=False)
+
+    def _fast_query(self, query_embedding: np.ndarray, n_results: int) -> List[Dict[str, Any]]:
+        """Brute-force cosine search over the in-memory embedding matrix."""
+        # Both operands are float32, so this is a single BLAS matrix-vector product
+        scores = self._fast_embs @ query_embedding
+
+        n = min(n_results, len(scores))
+        top = np.argpartition(-scores, n - 1)[:n] if n < len(scores) else np.arange(n)
+        top = top[np.argsort(-scores[top])]
+
+        # Report cosine distance, like ChromaDB does for our cosine collection
+        return [
+            {
+                'content': self._fast_documents[i],
+                'metadata': self._fast_metadatas[i],
+                'distance': float(1.0 - scores[i])
+            }
+            for i in top
+        ]
+
+    def query(self, text: str = None, query_embedding: np.ndarray = None, n_results: int = 5) -> List[Dict[str, Any]]:
         """
         Queries the vector database for relevant documents based on a given text.
         Args:
             text (str): The text to query with (e.g., a user's question).
+            query_embedding (np.ndarray): Optional normalized embedding of the text. If the caller
+                                          already has it, passing it avoids embedding the text again.
             n_results (int): The number of most similar documents to retrieve.
         Returns:
             List[Dict[str, Any]]: A list of dictionaries, each containing a retrieved document,
                                    its metadata, and its similarity score (distance).
         """
+        if query_embedding is None:
+            if text is None:
+                raise ValueError("Either text or query_embedding must be provided.")
+            query_embedding = self.embed_query(text)
+        query_embedding = np.asarray(query_embedding, dtype=np.float32)
+
+        if self._use_fast_path and self._fast_embs is not None:
+            return self._fast_query(query_embedding, n_results)
+
         # The ChromaDB query method finds the documents that are most semantically
         # similar to the input text's vector.
+        # We pass the NumPy array straight through, avoiding a round-trip through a Python list of floats.
         results = self.collection.query(
-            query_texts=[text],
+            query_embeddings=query_embedding[np.newaxis, :],
             n_results=n_results
         )
 
         # The results object is structured in a specific way, so we re-format it
         # to be more user-friendly.
-        formatted_results = []
-        for i in range(len(results['documents'][0])):
-            formatted_results.append({
-                'content': results['documents'][0][i],
-                'metadata': results['metadatas'][0][i],
-                'distance': results['distances'][0][i]
-            })
-        
-        return formatted_results
+        return [
+            {'content': document, 'metadata': metadata, 'distance': distance}
+            for document, metadata, distance in zip(
+                results['documents'][0],
+                results['metadatas'][0],
+                results['distances'][0]
+            )
+        ]
 
 # --- Simple test block to demonstrate functionality ---
 if __name__ == "__main__":
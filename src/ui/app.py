@@ -0,0 +1,63 @@
+# src/ui/app.py
+# Run from the project root with: python -m src.ui.app
+
+import asyncio
+import concurrent.futures
+import threading
+from flask import Flask, jsonify, request
+from src.chatbot.core import get_chatbot
+
+app = Flask(__name__)
+
+# Seconds a request may wait for its reply before we give up and return 504.
+CHAT_TIMEOUT = 120
+
+# All requests share one Chatbot. Its async pipeline runs on this single background
+# event loop, so requests arriving at the same time can be batched by the Ollama client.
+_loop = asyncio.new_event_loop()
+threading.Thread(target=_loop.run_forever, daemon=True).start()
+
+def _is_valid_history(history) -> bool:
+    """Checks that the client-supplied history only holds user/assistant messages with text content."""
+    if not isinstance(history, list):
+        return False
+    return all(
+        isinstance(message, dict)
+        and set(message) == {"role", "content"}
+        and message["role"] in ("user", "assistant")
+        and isinstance(message["content"], str)
+        for message in history
+    )
+
+@app.route("/chat", methods=["POST"])
+def chat():
+    """
+    Answers a user's message.
+    Expects JSON: {"message": "...", "history": [{"role": "user"/"assistant", "content": "..."}]}
+    The client keeps the conversation history and sends it with every message.
+    """
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({"error": "Request body must be a JSON object."}), 400
+    message = str(data.get("message", "")).strip()
+    if not message:
+        return jsonify({"error": "Field 'message' is required."}), 400
+    history = data.get("history") or []
+    if not _is_valid_history(history):
+        return jsonify({"error": "Field 'history' must be a list of {'role': 'user'/'assistant', 'content': str} objects."}), 400
+
+    future = asyncio.run_coroutine_threadsafe(
+        get_chatbot().process_message_async(message, history),
+        _loop
+    )
+    try:
+        response = future.result(timeout=CHAT_TIMEOUT)
+    except concurrent.futures.TimeoutError:
+        future.cancel()
+        return jsonify({"error": "The chatbot took too long to respond."}), 504
+    return jsonify({"response": response})
+
+if __name__ == "__main__":
+    # Load the models before accepting requests
+    get_chatbot()
+    app.run(host="0.0.0.0", port=5000, threaded=True)